@@ -1,11 +1,14 @@
 import streamlit as st
-import requests
-import pdfplumber
-import docx
-import chardet
+import httpx
 from io import BytesIO
-import json
+from pathlib import Path
+from itertools import groupby
+from operator import itemgetter
+import orjson
+import xxhash
 import time
+import re
+import gc
 
 # ============================================
 # PAGE CONFIGURATION - MUST BE FIRST COMMAND
@@ -16,11 +19,65 @@ st.set_page_config(
     layout="wide"
 )
 
+# ============================================
+# CONSTANTS
+# ============================================
+# Streaming UI refresh budget: flush after this many seconds or characters
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_CHARS = 64
+
+# Characters of each document sent to the API (8k chars ~= 2.5k tokens)
+DOC_CHARS_SENT = 8000
+
+# Prior user/assistant pairs sent to the API along with each new prompt
+MAX_HISTORY_TURNS = 16
+
+# User/assistant pairs kept in the on-screen chat transcript
+MAX_TRANSCRIPT_TURNS = 50
+
+# DeepSeek API keys: "sk-" followed by an alphanumeric token
+API_KEY_RE = re.compile(r"sk-[A-Za-z0-9]{20,}")
+
+# Task templates: name -> (system prompt, temperature)
+TEMPLATES = {
+    "Generate Python code": (
+        "You are an expert Python developer. Write clean, efficient, well-documented code based on the requirements. Include error handling, comments, and type hints where appropriate. Output only the code block unless explanation is specifically requested.",
+        0.2
+    ),
+    "Generate HTML webpage": (
+        "You are a front-end developer. Create responsive, modern HTML5/CSS3 webpages. Include appropriate meta tags, semantic structure, mobile-friendly design, and sample content. Provide complete HTML file ready to run.",
+        0.3
+    ),
+    "Summarize document": (
+        "You are a technical writer. Summarize documents clearly and concisely. Capture key points, decisions, and action items. Use bullet points and headings for readability. Keep the summary to about 10-20% of the original length.",
+        0.4
+    ),
+    "Commercial proposal": (
+        "You are a business consultant. Create professional commercial proposals based on the provided specifications. Include executive summary, scope, deliverables, timeline, pricing structure, and terms. Format with clear sections.",
+        0.5
+    ),
+    "Extract tables to Markdown": (
+        "You extract tabular data from documents and convert it to clean Markdown table format. Preserve all rows and columns accurately. If no tables are present, state that clearly.",
+        0.1
+    ),
+    "Refactor code": (
+        "You are a senior software engineer. Refactor the provided code to improve readability, performance, and maintainability. Follow best practices and design patterns. Explain the changes you made.",
+        0.2
+    ),
+    "Create technical documentation": (
+        "You are a technical writer. Create comprehensive documentation from code or specifications. Include overview, installation, usage examples, API reference, and troubleshooting. Use Markdown formatting.",
+        0.3
+    ),
+    "Analyze contract clauses": (
+        "You are a legal document analyst. Review the contract and identify key clauses, obligations, risks, and missing elements. Highlight unusual terms and provide plain-language explanations.",
+        0.2
+    )
+}
+
 # ============================================
 # CUSTOM CSS FOR PROFESSIONAL LOOK
 # ============================================
-def inject_custom_css():
-    st.markdown("""
+_CSS_HTML = """
     <style>
         .main-header {
             font-size: 2.5rem;
@@ -51,7 +108,13 @@ def inject_custom_css():
             background-color: #FFFBEB;
         }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+@st.cache_resource(show_spinner=False)
+def inject_custom_css():
+    """Inject the constant CSS block - later reruns replay the cached element"""
+    st.markdown(_CSS_HTML, unsafe_allow_html=True)
+    return True
 
 inject_custom_css()
 
@@ -64,12 +127,17 @@ def init_session_state():
         "messages": [],                # Chat history
         "api_key": "",                # DeepSeek API key
         "uploaded_files_content": [], # Processed file content
+        "doc_system_message": None,   # Prebuilt document message for the API
+        "processed_upload_ids": [],   # Uploader file ids already processed
         "current_mode": "deepseek-chat",  # Model selection
         "temperature": 0.3,           # Response creativity
         "system_prompt": "You are an expert technical document analyst and code generator. Process the provided documents and complete the user's task exactly as instructed. When generating code, include comments and error handling. When summarizing, be concise and highlight key points.",
         "documents_attached": False,  # Track if docs already sent in conversation
+        "api_messages": [{"role": "system", "content": ""}],  # Messages sent to the API
+        "api_prefix_len": 1,          # System prompt + attached document message
         "stream": True,              # Enable streaming by default
-        "template": "Custom (no template)"  # Selected prompt template
+        "template": "Custom (no template)",  # Selected prompt template
+        "latencies": []               # Per-turn timings and token usage
     }
     
     for key, value in defaults.items():
@@ -81,115 +149,266 @@ init_session_state()
 # ============================================
 # FILE PROCESSING FUNCTIONS
 # ============================================
+class ExtractionError(Exception):
+    """A document could not be parsed - reported in the upload section"""
+
+# Parser libraries are imported on first use, not at startup - they are
+# slow to import and only needed once a file of that type is uploaded.
+# Later imports are a sys.modules lookup.
 def extract_text_from_pdf(file_bytes):
     """Extract text from PDF files"""
+    import fitz  # PyMuPDF
+    
     text = ""
     try:
+        # PyMuPDF extracts in native code - far faster than pdfplumber
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            text = "".join(page.get_text("text") for page in doc)
+    except Exception:
+        text = ""
+    
+    # Fall back to pdfplumber when PyMuPDF fails or finds no text
+    if not text.strip():
+        text = extract_text_from_pdf_pdfplumber(file_bytes)
+    return text
+
+def extract_text_from_pdf_pdfplumber(file_bytes):
+    """Extract text from PDF files with pdfplumber (fallback)"""
+    import pdfplumber
+    
+    try:
+        parts = []
         with pdfplumber.open(BytesIO(file_bytes)) as pdf:
             for page in pdf.pages:
                 page_text = page.extract_text()
                 if page_text:
-                    text += page_text + "\n"
+                    parts.append(page_text + "\n")
     except Exception as e:
-        st.error(f"PDF processing error: {e}")
-    return text
+        raise ExtractionError(f"PDF processing error: {e}") from e
+    # Join once instead of += in the loop (quadratic copying on large files)
+    return "".join(parts)
 
 def extract_text_from_docx(file_bytes):
     """Extract text from Word documents"""
-    text = ""
+    import docx
+    
     try:
         doc = docx.Document(BytesIO(file_bytes))
-        for para in doc.paragraphs:
-            text += para.text + "\n"
     except Exception as e:
-        st.error(f"DOCX processing error: {e}")
-    return text
+        raise ExtractionError(f"DOCX processing error: {e}") from e
+    return "".join(para.text + "\n" for para in doc.paragraphs)
 
 def extract_text_from_txt(file_bytes):
     """Extract text from text files with encoding detection"""
+    # Most text files are UTF-8 - only run chardet when that fails
     try:
-        encoding = chardet.detect(file_bytes)['encoding']
-        text = file_bytes.decode(encoding or 'utf-8', errors='ignore')
+        return file_bytes.decode('utf-8-sig')  # also strips a BOM
+    except UnicodeDecodeError:
+        pass
+    
+    import chardet
+    try:
+        # chardet's accuracy plateaus quickly, so a 64 KiB sample is enough
+        encoding = chardet.detect(file_bytes[:65536])['encoding']
+        text = file_bytes.decode(encoding or 'latin-1', errors='ignore')
     except:
         text = file_bytes.decode('utf-8', errors='ignore')
     return text
 
-def process_uploaded_file(uploaded_file):
-    """Route file to appropriate extractor based on type"""
-    file_bytes = uploaded_file.read()
-    file_type = uploaded_file.type
-    file_name = uploaded_file.name
-    
-    if "pdf" in file_type:
-        text = extract_text_from_pdf(file_bytes)
-    elif "word" in file_type or "docx" in file_type:
-        text = extract_text_from_docx(file_bytes)
-    elif "text" in file_type or "txt" in file_type:
-        text = extract_text_from_txt(file_bytes)
+# Extractor dispatch tables
+EXTRACTORS_BY_MIME = {
+    "application/pdf": extract_text_from_pdf,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": extract_text_from_docx,
+    "text/plain": extract_text_from_txt
+}
+EXTRACTORS_BY_SUFFIX = {
+    ".pdf": extract_text_from_pdf,
+    ".docx": extract_text_from_docx,
+    ".txt": extract_text_from_txt
+}
+
+def process_uploaded_files(uploaded_files, on_file_done=None):
+    """Process several uploads one after another, in upload order"""
+    # Files whose content was already processed in this batch (the same file
+    # uploaded twice, possibly renamed) are skipped: hashing costs far less
+    # than parsing, and the duplicate would only repeat the same document in
+    # the prompt.
+    #
+    # Files are parsed sequentially on the script thread. A thread pool
+    # buys nothing here: pdfplumber is pure Python and PyMuPDF keeps the
+    # GIL during its calls, and PyMuPDF is not safe to call from several
+    # threads at once.
+    results = []
+    seen_hashes = set()
+    for f in uploaded_files:
+        # getvalue() returns the full payload on every rerun, unlike read()
+        # which is empty once the buffer position has moved to the end.
+        # UploadedFile is a BytesIO over Streamlit's own bytes, so getvalue()
+        # hands back that same object without copying. Don't switch to
+        # getbuffer(): an exported memoryview forces every later getvalue()
+        # to copy, and PyMuPDF/chardet/st.cache_data don't take memoryviews.
+        file_bytes = f.getvalue()
+        file_hash = hash_file_bytes(file_bytes)
+        if file_hash in seen_hashes:
+            continue
+        seen_hashes.add(file_hash)
+        
+        processed = _process_file_bytes(f.name, f.type, file_hash, file_bytes)
+        results.append(processed)
+        # Report each file as soon as it is done
+        if on_file_done:
+            on_file_done(processed)
+    return results
+
+def hash_file_bytes(file_bytes):
+    """Fast content hash used as the cache key for uploaded payloads"""
+    return xxhash.xxh3_64_hexdigest(file_bytes)
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def _process_file_bytes(file_name, file_type, file_hash, _file_bytes):
+    """Extract and truncate text - cached so reruns skip re-parsing"""
+    # st.cache_data always hashes bytes arguments with md5 (hash_funcs can't
+    # override bytes), so the payload is passed as an unhashed _argument and
+    # the much faster xxhash digest (see hash_file_bytes) is the cache key.
+    # Only this truncated result is cached: the extractors themselves are
+    # not, so the full text of large documents isn't held in memory too.
+    
+    # MIME type first, then the file extension (browsers may send a generic
+    # or empty type)
+    extractor = EXTRACTORS_BY_MIME.get(file_type) or EXTRACTORS_BY_SUFFIX.get(Path(file_name).suffix.lower())
+    error = None
+    if extractor:
+        try:
+            text = extractor(_file_bytes)
+        except ExtractionError as e:
+            # Returned rather than shown, so the caller reports it in the
+            # upload section - also when the result comes from the cache
+            text, error = "", str(e)
     else:
         text = f"[Unsupported file type: {file_type}]"
     
-    # Limit text length to avoid token overflow (50k chars ~= 15k tokens)
-    truncated_text = text[:50000]
+    # Only the part that is sent to the API is kept in session state
+    truncated_text = text[:DOC_CHARS_SENT]
     
     return {
         "name": file_name,
         "content": truncated_text,
-        "size": len(text)
+        "size": len(text),
+        "error": error
     }
 
 # ============================================
 # DEEPSEEK API CALL FUNCTIONS
 # ============================================
-def call_deepseek_api_stream(payload, headers):
-    """Streaming version – yields chunks with reasoning/content"""
-    response = requests.post(
-        "https://api.deepseek.com/v1/chat/completions",
-        headers=headers,
-        json=payload,
-        stream=True,
-        timeout=120
+@st.cache_resource
+def get_http_client():
+    """Shared HTTP/2 client - keeps the connection alive across reruns"""
+    return httpx.Client(
+        http2=True,
+        # Fail fast if DeepSeek is unreachable, but give generation time to
+        # finish - a hung request would otherwise pin this session's script
+        timeout=httpx.Timeout(120.0, connect=5.0),
+        headers={"Content-Type": "application/json"},
+        limits=httpx.Limits(max_keepalive_connections=4)
     )
+
+def iter_sse_data(response):
+    """Yield the payload of each SSE 'data:' line until [DONE]"""
+    # Read whole network blocks and split events ourselves - line iterators
+    # walk the stream through a slow per-line generator on busy streams
+    buffer = b""
+    for block in response.iter_bytes():
+        # SSE allows CRLF line endings - normalise them so the blank line
+        # between events is always b"\n\n". A CRLF split across blocks is
+        # joined up here too, as the CR stays in the partial event.
+        buffer = (buffer + block).replace(b"\r\n", b"\n")
+        
+        # Events end with a blank line; keep the trailing partial event
+        *events, buffer = buffer.split(b"\n\n")
+        for event in events:
+            for data in _iter_event_data(event):
+                if data == b"[DONE]":
+                    return
+                yield data
     
+    # A last event without the closing blank line still counts (it may
+    # be the chunk that carries token usage)
+    for data in _iter_event_data(buffer):
+        if data == b"[DONE]":
+            return
+        yield data
+
+def _iter_event_data(event):
+    """Yield the payload of each 'data:' line of one SSE event"""
+    for line in event.split(b"\n"):
+        if line.startswith(b"data:"):
+            # A single space after the colon is optional
+            data = line[5:]
+            yield data[1:] if data.startswith(b" ") else data
+
+def call_deepseek_api_stream(payload, headers):
+    """Streaming version – yields chunks with reasoning/content"""
     reasoning_collected = ""
     content_collected = ""
+    usage = {}
     
-    for line in response.iter_lines():
-        if line:
-            line = line.decode('utf-8')
-            if line.startswith("data: "):
-                data = line[6:]
-                if data == "[DONE]":
-                    break
-                try:
-                    chunk = json.loads(data)
-                    delta = chunk["choices"][0]["delta"]
-                    
-                    # Reasoning content (specific to deepseek-reasoner)
-                    if "reasoning_content" in delta:
-                        reasoning_chunk = delta["reasoning_content"]
-                        reasoning_collected += reasoning_chunk
-                        yield {"type": "reasoning", "content": reasoning_chunk}
-                    
-                    # Normal content
-                    if "content" in delta:
-                        content_chunk = delta["content"]
-                        content_collected += content_chunk
-                        yield {"type": "content", "content": content_chunk}
+    try:
+        with get_http_client().stream(
+            "POST",
+            "https://api.deepseek.com/v1/chat/completions",
+            headers=headers,
+            json=payload
+        ) as response:
+            if response.status_code != 200:
+                response.read()
+                content_collected = f"❌ API Error: {response.status_code} - {response.text}"
+                yield {"type": "content", "content": content_collected}
+            else:
+                for data in iter_sse_data(response):
+                    try:
+                        # orjson parses the raw bytes directly - no per-line UTF-8 decode
+                        chunk = orjson.loads(data)
+                        # Token usage comes with the last chunk, which may
+                        # have no choices
+                        if chunk.get("usage"):
+                            usage = chunk["usage"]
+                        delta = chunk["choices"][0]["delta"]
+                        
+                        # Reasoning content (specific to deepseek-reasoner);
+                        # absent or null when the model is producing content
+                        reasoning_chunk = delta.get("reasoning_content")
+                        if reasoning_chunk:
+                            reasoning_collected += reasoning_chunk
+                            yield {"type": "reasoning", "content": reasoning_chunk}
                         
-                except json.JSONDecodeError:
-                    continue
-                except KeyError:
-                    continue
+                        # Normal content
+                        content_chunk = delta.get("content")
+                        if content_chunk:
+                            content_collected += content_chunk
+                            yield {"type": "content", "content": content_chunk}
+                        
+                    except orjson.JSONDecodeError:
+                        continue
+                    except (KeyError, IndexError):
+                        continue
+    except httpx.HTTPError as e:
+        # Shown after any partial output, like the non-streaming error replies
+        if isinstance(e, httpx.TimeoutException):
+            error = "❌ Timeout: DeepSeek did not respond in time. Please try again."
+        else:
+            error = f"❌ Connection Error: {str(e)}"
+        error = ("\n\n" if content_collected else "") + error
+        content_collected += error
+        yield {"type": "content", "content": error}
     
-    yield {"type": "done", "reasoning": reasoning_collected, "content": content_collected}
+    yield {"type": "done", "reasoning": reasoning_collected, "content": content_collected, "usage": usage}
 
 def call_deepseek_api(messages, api_key, model="deepseek-chat", temperature=0.3, stream=False):
     """Send conversation to DeepSeek API with support for reasoning traces"""
     
+    # Content-Type is set on the shared client
     headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+        "Authorization": f"Bearer {api_key}"
     }
     
     payload = {
@@ -203,11 +422,10 @@ def call_deepseek_api(messages, api_key, model="deepseek-chat", temperature=0.3,
         if stream:
             return call_deepseek_api_stream(payload, headers)
         else:
-            response = requests.post(
+            response = get_http_client().post(
                 "https://api.deepseek.com/v1/chat/completions",
                 headers=headers,
-                json=payload,
-                timeout=120
+                json=payload
             )
             
             if response.status_code == 200:
@@ -220,7 +438,8 @@ def call_deepseek_api(messages, api_key, model="deepseek-chat", temperature=0.3,
                 
                 return {
                     "content": content,
-                    "reasoning": reasoning
+                    "reasoning": reasoning,
+                    "usage": result.get("usage") or {}
                 }
             else:
                 return {
@@ -228,6 +447,11 @@ def call_deepseek_api(messages, api_key, model="deepseek-chat", temperature=0.3,
                     "reasoning": ""
                 }
                 
+    except httpx.TimeoutException:
+        return {
+            "content": "❌ Timeout: DeepSeek did not respond in time. Please try again.",
+            "reasoning": ""
+        }
     except Exception as e:
         return {
             "content": f"❌ Connection Error: {str(e)}",
@@ -237,226 +461,331 @@ def call_deepseek_api(messages, api_key, model="deepseek-chat", temperature=0.3,
 # ============================================
 # CONVERSATION BUILDER (MEMORY & DOCUMENTS)
 # ============================================
+def build_document_message(files_content):
+    """Build the document system message (once per upload, not per turn)"""
+    if not files_content:
+        return None
+    context = "=== DOCUMENTS ===\n\n" + "".join(
+        # Content is already cut to DOC_CHARS_SENT chars per file
+        f"--- Document {idx}: {file['name']} ---\n{file['content']}\n\n"
+        for idx, file in enumerate(files_content, 1)
+    )
+    return {
+        "role": "system",
+        "content": f"The user attached the following documents for reference throughout the conversation:\n\n{context}"
+    }
+
 def build_conversation_messages(new_user_prompt):
-    """Construct the full message list for the API call with proper memory"""
+    """Append the new turn to the stored API message list and return it"""
     
-    messages = []
+    # The list lives in session state and grows by one turn at a time
+    # instead of being rebuilt from the whole chat history on every call
+    messages = st.session_state.api_messages
     
-    # 1. System prompt (defines behavior)
-    system_msg = {
+    # 1. System prompt (defines behavior) - refreshed in case it was edited
+    messages[0] = {
         "role": "system", 
         "content": st.session_state.system_prompt
     }
-    messages.append(system_msg)
-    
-    # 2. Document context - send only ONCE at the beginning of conversation
-    if st.session_state.uploaded_files_content and not st.session_state.documents_attached:
-        context = "=== DOCUMENTS ===\n\n"
-        for idx, file in enumerate(st.session_state.uploaded_files_content, 1):
-            context += f"--- Document {idx}: {file['name']} ---\n"
-            context += file['content'][:8000] + "\n\n"  # Send first 8000 chars per file
-        
-        messages.append({
-            "role": "user",
-            "content": f"Please process the following documents. They are attached for reference throughout our conversation:\n\n{context}"
-        })
-        # Assistant acknowledgment – creates natural flow
-        messages.append({
-            "role": "assistant",
-            "content": "I have loaded the documents. I will refer to them as needed. Please tell me what you'd like me to do."
-        })
+    
+    # 2. Document context - (re)attached right after the system prompt when
+    # documents change, then kept for the rest of the conversation. A stable
+    # [system, documents] prefix lets DeepSeek's context cache reuse it
+    # across turns instead of re-processing the documents every request.
+    if not st.session_state.documents_attached:
+        doc_messages = []
+        if st.session_state.doc_system_message:
+            doc_messages.append(st.session_state.doc_system_message)
+        messages[1:st.session_state.api_prefix_len] = doc_messages
+        st.session_state.api_prefix_len = 1 + len(doc_messages)
         st.session_state.documents_attached = True
     
-    # 3. Conversation history (exclude reasoning entries to keep API clean)
-    for msg in st.session_state.messages:
-        if msg["role"] in ["user", "assistant"]:
-            messages.append(msg)
+    # 3. Current user prompt - history is already bounded by trim_history()
+    messages.append({"role": "user", "content": new_user_prompt})
+    return list(messages)
+
+def trim_history():
+    """Drop the oldest turns so stored history stays a fixed size"""
+    
+    # API history - pinned prefix plus the last MAX_HISTORY_TURNS
+    # user/assistant pairs, so per-turn payload stops growing with chat length
+    api_messages = st.session_state.api_messages
+    window_start = len(api_messages) - 2 * MAX_HISTORY_TURNS
+    if window_start > st.session_state.api_prefix_len:
+        del api_messages[st.session_state.api_prefix_len:window_start]
     
-    # 4. Current user prompt (if not already the last message)
-    if not messages or messages[-1]["role"] != "user" or messages[-1]["content"] != new_user_prompt:
-        messages.append({"role": "user", "content": new_user_prompt})
+    # Transcript - bounds the per-rerun render cost of the chat history
+    messages = st.session_state.messages
+    if len(messages) > 2 * MAX_TRANSCRIPT_TURNS:
+        del messages[:len(messages) - 2 * MAX_TRANSCRIPT_TURNS]
     
-    return messages
+    # Latency log - one row per turn
+    del st.session_state.latencies[:-MAX_TRANSCRIPT_TURNS]
 
 # ============================================
 # UI SIDEBAR
 # ============================================
+@st.cache_data(show_spinner=False)
+def get_default_api_key():
+    """API key from secrets - read once instead of on every rerun"""
+    return st.secrets.get("DEEPSEEK_API_KEY", "")
+
+def is_valid_api_key(api_key):
+    """Check the API key format (not whether DeepSeek accepts it)"""
+    return API_KEY_RE.fullmatch(api_key) is not None
+
+def update_api_key():
+    """Store the entered API key and its validation status (on_change)"""
+    if st.session_state.api_key_input:
+        st.session_state.api_key = st.session_state.api_key_input
+    
+    if st.session_state.api_key:
+        if is_valid_api_key(st.session_state.api_key):
+            st.session_state.api_key_status = ("success", "✅ API key valid")
+        else:
+            st.session_state.api_key_status = ("warning", "⚠️ API key should be 'sk-' followed by at least 20 letters or digits")
+    else:
+        st.session_state.api_key_status = ("error", "❌ API key required")
+
+@st.fragment
+def render_api_key_section():
+    """API key input and validation (fragment)"""
+    # ===== API KEY SECTION =====
+    st.markdown("### 🔑 API Configuration")
+    
+    # Try to get from secrets first, then allow manual input. Validation
+    # only runs when the key changes, not on every rerun.
+    if "api_key_input" not in st.session_state:
+        st.session_state.api_key_input = st.session_state.api_key or get_default_api_key()
+        update_api_key()
+    st.text_input(
+        "DeepSeek API Key",
+        type="password",
+        key="api_key_input",
+        on_change=update_api_key,
+        placeholder="sk-...",
+        help="Your API key from platform.deepseek.com (funded via WeChat Pay)"
+    )
+    
+    status, message = st.session_state.api_key_status
+    getattr(st, status)(message)
+
+@st.fragment
+def render_model_settings():
+    """Model, system prompt and template controls (fragment)"""
+    # ===== MODEL SETTINGS =====
+    st.markdown("### 🧠 Model Settings")
+    
+    st.session_state.current_mode = st.selectbox(
+        "Model",
+        options=["deepseek-chat", "deepseek-reasoner"],
+        index=0,
+        help="deepseek-chat: fast, general tasks. deepseek-reasoner: shows reasoning, better for complex problems."
+    )
+    
+    st.session_state.temperature = st.slider(
+        "Temperature",
+        min_value=0.0,
+        max_value=1.0,
+        value=st.session_state.temperature,
+        step=0.1,
+        help="Lower = more precise, higher = more creative"
+    )
+    
+    st.session_state.stream = st.checkbox(
+        "Stream responses",
+        value=st.session_state.stream,
+        help="Show words as they are generated (faster feel)"
+    )
+    
+    st.markdown("---")
+    
+    # ===== SYSTEM PROMPT =====
+    st.markdown("### 📝 System Prompt")
+    
+    st.session_state.system_prompt = st.text_area(
+        "Instructions to AI",
+        value=st.session_state.system_prompt,
+        height=120,
+        help="This defines how the AI behaves"
+    )
+    
+    st.markdown("---")
+    
+    # ===== PROMPT TEMPLATES =====
+    st.markdown("### 📋 Task Templates")
+    template_options = ["Custom (no template)", *TEMPLATES]
+    
+    selected_template = st.selectbox(
+        "Quick start templates",
+        template_options,
+        index=template_options.index(st.session_state.template) if st.session_state.template in template_options else 0
+    )
+    
+    # Apply template if changed
+    if selected_template != st.session_state.template:
+        st.session_state.template = selected_template
+        if selected_template in TEMPLATES:
+            st.session_state.system_prompt, st.session_state.temperature = TEMPLATES[selected_template]
+
+def clear_documents():
+    """Forget the loaded documents (on_click)"""
+    st.session_state.uploaded_files_content = []
+    st.session_state.doc_system_message = None
+    st.session_state.documents_attached = False
+
+@st.fragment
+def render_document_upload():
+    """Document upload, processing and loaded files list (fragment)"""
+    # ===== FILE UPLOAD =====
+    st.markdown("### 📁 Document Upload")
+    st.markdown('<div class="uploader-box">', unsafe_allow_html=True)
+    
+    uploaded_files = st.file_uploader(
+        "Upload documents (PDF, DOCX, TXT)",
+        type=["pdf", "docx", "txt"],
+        accept_multiple_files=True,
+        key="file_uploader"
+    )
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+    
+    # Process newly uploaded files - the uploader keeps returning the same
+    # files on every rerun (also after Clear Documents), so skip them
+    # unless its contents actually changed
+    upload_ids = [f.file_id for f in uploaded_files] if uploaded_files else []
+    if uploaded_files and upload_ids != st.session_state.processed_upload_ids:
+        st.session_state.processed_upload_ids = upload_ids
+        parse_start = time.perf_counter()
+        with st.status("Processing documents...", expanded=True) as status:
+            def show_processed(processed):
+                if processed["error"]:
+                    st.error(f"{processed['name']}: {processed['error']}")
+                else:
+                    st.caption(f"✅ {processed['name']} - {processed['size']} chars")
+                status.update(label=f"Parsed {processed['name']}")
+            
+            new_files_content = process_uploaded_files(uploaded_files, on_file_done=show_processed)
+            status.update(
+                label=f"Processed {len(new_files_content)} documents in {time.perf_counter() - parse_start:.2f}s",
+                state="complete",
+                expanded=False
+            )
+            # Parsing large files leaves many short-lived objects (page
+            # trees, full-text strings) - reclaim them right away
+            gc.collect()
+    
+            # Update session state
+            st.session_state.uploaded_files_content = new_files_content
+            # Only re-attach when the documents actually differ, so
+            # re-uploading the same files keeps the cached API prefix
+            doc_message = build_document_message(new_files_content)
+            if doc_message != st.session_state.doc_system_message:
+                st.session_state.doc_system_message = doc_message
+                # Reset document attachment flag so new docs are sent in next message
+                st.session_state.documents_attached = False
+    
+    # Show currently loaded documents
+    if st.session_state.uploaded_files_content:
+        st.markdown("#### Loaded Documents:")
+        for file in st.session_state.uploaded_files_content:
+            st.caption(f"📄 {file['name']} ({file['size']} chars)")
+    
+        # Cleared in on_click, before the fragment rerun the click
+        # triggers, so the list disappears without another st.rerun().
+        # No re-attach button: the documents stay in the API prefix on
+        # every turn until they change or are cleared.
+        st.button("🗑️ Clear Documents", on_click=clear_documents, use_container_width=True)
+
+def reset_conversation():
+    """Start a new conversation (on_click)"""
+    st.session_state.messages = []
+    st.session_state.api_messages = [{"role": "system", "content": ""}]
+    st.session_state.api_prefix_len = 1
+    st.session_state.documents_attached = False  # Docs need to be re-sent
+
 def render_sidebar():
     """Render the sidebar with all controls"""
     with st.sidebar:
         st.markdown("## ⚙️ Control Center")
         st.markdown("---")
         
-        # ===== API KEY SECTION =====
-        st.markdown("### 🔑 API Configuration")
-        
-        # Try to get from secrets first, then allow manual input
-        default_key = st.secrets.get("DEEPSEEK_API_KEY", "")
-        api_key_input = st.text_input(
-            "DeepSeek API Key",
-            type="password",
-            value=st.session_state.api_key or default_key,
-            placeholder="sk-...",
-            help="Your API key from platform.deepseek.com (funded via WeChat Pay)"
-        )
-        
-        if api_key_input:
-            st.session_state.api_key = api_key_input
-        
-        if st.session_state.api_key:
-            if st.session_state.api_key.startswith("sk-"):
-                st.success("✅ API key valid")
-            else:
-                st.warning("⚠️ API key should start with 'sk-'")
-        else:
-            st.error("❌ API key required")
-        
+        # Each section is a fragment: using its widgets reruns just that
+        # section instead of the whole app, including the chat history
+        render_api_key_section()
         st.markdown("---")
-        
-        # ===== MODEL SETTINGS =====
-        st.markdown("### 🧠 Model Settings")
-        
-        st.session_state.current_mode = st.selectbox(
-            "Model",
-            options=["deepseek-chat", "deepseek-reasoner"],
-            index=0,
-            help="deepseek-chat: fast, general tasks. deepseek-reasoner: shows reasoning, better for complex problems."
-        )
-        
-        st.session_state.temperature = st.slider(
-            "Temperature",
-            min_value=0.0,
-            max_value=1.0,
-            value=st.session_state.temperature,
-            step=0.1,
-            help="Lower = more precise, higher = more creative"
-        )
-        
-        st.session_state.stream = st.checkbox(
-            "Stream responses",
-            value=st.session_state.stream,
-            help="Show words as they are generated (faster feel)"
-        )
-        
+        render_model_settings()
         st.markdown("---")
-        
-        # ===== SYSTEM PROMPT =====
-        st.markdown("### 📝 System Prompt")
-        
-        st.session_state.system_prompt = st.text_area(
-            "Instructions to AI",
-            value=st.session_state.system_prompt,
-            height=120,
-            help="This defines how the AI behaves"
-        )
-        
-        st.markdown("---")
-        
-        # ===== PROMPT TEMPLATES =====
-        st.markdown("### 📋 Task Templates")
-        template_options = [
-            "Custom (no template)",
-            "Generate Python code",
-            "Generate HTML webpage",
-            "Summarize document",
-            "Commercial proposal",
-            "Extract tables to Markdown",
-            "Refactor code",
-            "Create technical documentation",
-            "Analyze contract clauses"
-        ]
-        
-        selected_template = st.selectbox(
-            "Quick start templates",
-            template_options,
-            index=template_options.index(st.session_state.template) if st.session_state.template in template_options else 0
-        )
-        
-        # Apply template if changed
-        if selected_template != st.session_state.template:
-            st.session_state.template = selected_template
-            if selected_template == "Generate Python code":
-                st.session_state.system_prompt = "You are an expert Python developer. Write clean, efficient, well-documented code based on the requirements. Include error handling, comments, and type hints where appropriate. Output only the code block unless explanation is specifically requested."
-                st.session_state.temperature = 0.2
-            elif selected_template == "Generate HTML webpage":
-                st.session_state.system_prompt = "You are a front-end developer. Create responsive, modern HTML5/CSS3 webpages. Include appropriate meta tags, semantic structure, mobile-friendly design, and sample content. Provide complete HTML file ready to run."
-                st.session_state.temperature = 0.3
-            elif selected_template == "Summarize document":
-                st.session_state.system_prompt = "You are a technical writer. Summarize documents clearly and concisely. Capture key points, decisions, and action items. Use bullet points and headings for readability. Keep the summary to about 10-20% of the original length."
-                st.session_state.temperature = 0.4
-            elif selected_template == "Commercial proposal":
-                st.session_state.system_prompt = "You are a business consultant. Create professional commercial proposals based on the provided specifications. Include executive summary, scope, deliverables, timeline, pricing structure, and terms. Format with clear sections."
-                st.session_state.temperature = 0.5
-            elif selected_template == "Extract tables to Markdown":
-                st.session_state.system_prompt = "You extract tabular data from documents and convert it to clean Markdown table format. Preserve all rows and columns accurately. If no tables are present, state that clearly."
-                st.session_state.temperature = 0.1
-            elif selected_template == "Refactor code":
-                st.session_state.system_prompt = "You are a senior software engineer. Refactor the provided code to improve readability, performance, and maintainability. Follow best practices and design patterns. Explain the changes you made."
-                st.session_state.temperature = 0.2
-            elif selected_template == "Create technical documentation":
-                st.session_state.system_prompt = "You are a technical writer. Create comprehensive documentation from code or specifications. Include overview, installation, usage examples, API reference, and troubleshooting. Use Markdown formatting."
-                st.session_state.temperature = 0.3
-            elif selected_template == "Analyze contract clauses":
-                st.session_state.system_prompt = "You are a legal document analyst. Review the contract and identify key clauses, obligations, risks, and missing elements. Highlight unusual terms and provide plain-language explanations."
-                st.session_state.temperature = 0.2
-        
-        st.markdown("---")
-        
-        # ===== FILE UPLOAD =====
-        st.markdown("### 📁 Document Upload")
-        st.markdown('<div class="uploader-box">', unsafe_allow_html=True)
-        
-        uploaded_files = st.file_uploader(
-            "Upload documents (PDF, DOCX, TXT)",
-            type=["pdf", "docx", "txt"],
-            accept_multiple_files=True,
-            key="file_uploader"
-        )
-        
-        st.markdown('</div>', unsafe_allow_html=True)
-        
-        # Process newly uploaded files
-        if uploaded_files:
-            with st.spinner("Processing documents..."):
-                new_files_content = []
-                for file in uploaded_files:
-                    processed = process_uploaded_file(file)
-                    new_files_content.append(processed)
-                    st.caption(f"✅ {processed['name']} - {processed['size']} chars")
-                
-                # Update session state
-                st.session_state.uploaded_files_content = new_files_content
-                # Reset document attachment flag so new docs are sent in next message
-                st.session_state.documents_attached = False
-        
-        # Show currently loaded documents
-        if st.session_state.uploaded_files_content:
-            st.markdown("#### Loaded Documents:")
-            for file in st.session_state.uploaded_files_content:
-                st.caption(f"📄 {file['name']} ({file['size']} chars)")
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("🗑️ Clear Documents", use_container_width=True):
-                    st.session_state.uploaded_files_content = []
-                    st.session_state.documents_attached = False
-                    st.rerun()
-            with col2:
-                if st.button("🔄 Re-attach", use_container_width=True):
-                    st.session_state.documents_attached = False
-                    st.success("Documents will be re-sent in next message!")
-        
+        render_document_upload()
         st.markdown("---")
         
         # ===== NEW CHAT BUTTON =====
-        if st.button("✨ New Conversation", use_container_width=True):
-            st.session_state.messages = []
-            st.session_state.documents_attached = False  # Docs need to be re-sent
-            st.rerun()
+        # Reset in on_click, which runs before the rerun the click triggers,
+        # so the chat renders empty without a second st.rerun()
+        st.button("✨ New Conversation", on_click=reset_conversation, use_container_width=True)
 
 # ============================================
 # MAIN CHAT INTERFACE
 # ============================================
+def stream_content_chunks(response_data, reasoning_placeholder, collected):
+    """Yield content text for st.write_stream, rendering reasoning on the side"""
+    # Every update re-sends the whole text to the browser, so coalesce
+    # chunks and only flush on a time/size budget
+    last_flush = 0.0
+    pending_reasoning = 0
+    pending_content = ""
+    
+    for chunk in response_data:
+        if chunk["type"] != "done" and "first_token" not in collected:
+            collected["first_token"] = time.perf_counter()
+        
+        if chunk["type"] == "reasoning":
+            collected["reasoning"] += chunk["content"]
+            pending_reasoning += len(chunk["content"])
+        elif chunk["type"] == "content":
+            pending_content += chunk["content"]
+        else:
+            # "done" - st.write_stream already holds the full content
+            collected["usage"] = chunk["usage"]
+            continue
+        
+        if (pending_reasoning + len(pending_content) > STREAM_FLUSH_CHARS
+                or time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL):
+            if pending_reasoning:
+                with reasoning_placeholder.expander("🧠 Deep Thinking", expanded=False):
+                    st.markdown(collected["reasoning"] + "▌")
+                pending_reasoning = 0
+            if pending_content:
+                yield pending_content
+                pending_content = ""
+            last_flush = time.monotonic()
+    
+    # Final flush
+    if collected["reasoning"]:
+        with reasoning_placeholder.expander("🧠 Deep Thinking", expanded=False):
+            st.markdown(collected["reasoning"])
+    if pending_content:
+        yield pending_content
+
+def render_transcript():
+    """Chat history - the current turn is drawn live below it"""
+    # Consecutive turns of the same role share one bubble and one markdown
+    # element instead of one of each per message
+    for role, run in groupby(st.session_state.messages, key=itemgetter("role")):
+        with st.chat_message(role):
+            parts = []
+            for message in run:
+                # Reasoning trace is stored on the reply itself and is drawn
+                # right above it, so it ends the markdown block before it
+                if message.get("reasoning"):
+                    if parts:
+                        st.markdown("\n\n---\n\n".join(parts))
+                        parts = []
+                    with st.expander("🧠 Deep Thinking (previous)", expanded=False):
+                        st.markdown(message["reasoning"])
+                parts.append(message["content"])
+            st.markdown("\n\n---\n\n".join(parts))
+
 def render_main_chat():
     """Render the main chat interface"""
     
@@ -465,18 +794,7 @@ def render_main_chat():
     st.markdown("*Upload documents, describe your task, get results with full reasoning.*")
     
     # Display chat history
-    for message in st.session_state.messages:
-        if message["role"] == "user":
-            with st.chat_message("user"):
-                st.markdown(message["content"])
-        elif message["role"] == "assistant":
-            with st.chat_message("assistant"):
-                st.markdown(message["content"])
-        elif message["role"] == "assistant_reasoning":
-            # Show reasoning in expander (for non-streaming history)
-            with st.chat_message("assistant"):
-                with st.expander("🧠 Deep Thinking (previous)", expanded=False):
-                    st.markdown(message["content"])
+    render_transcript()
     
     # Chat input
     if prompt := st.chat_input("Describe what you want to do with your documents..."):
@@ -485,8 +803,8 @@ def render_main_chat():
             st.error("⚠️ Please enter your DeepSeek API key in the sidebar")
             st.stop()
         
-        if not st.session_state.api_key.startswith("sk-"):
-            st.error("⚠️ Invalid API key format. Should start with 'sk-'")
+        if not is_valid_api_key(st.session_state.api_key):
+            st.error("⚠️ Invalid API key format. Should be 'sk-' followed by at least 20 letters or digits")
             st.stop()
         
         # Add user message to chat
@@ -496,61 +814,72 @@ def render_main_chat():
         
         # Generate response
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..." if st.session_state.current_mode == "deepseek-reasoner" else "Processing..."):
-                
-                # Build messages list with conversation memory
-                messages = build_conversation_messages(prompt)
+            
+            # Build messages list with conversation memory
+            messages = build_conversation_messages(prompt)
+            api_kwargs = dict(
+                messages=messages,
+                api_key=st.session_state.api_key,
+                model=st.session_state.current_mode,
+                temperature=st.session_state.temperature
+            )
+            
+            # Handle streaming vs non-streaming
+            request_start = time.perf_counter()
+            if st.session_state.stream:
+                reasoning_placeholder = st.empty()
+                collected = {"reasoning": ""}
                 
-                # Call API with appropriate streaming mode
-                response_data = call_deepseek_api(
-                    messages=messages,
-                    api_key=st.session_state.api_key,
-                    model=st.session_state.current_mode,
-                    temperature=st.session_state.temperature,
-                    stream=st.session_state.stream
+                # No spinner: st.write_stream renders the content with a live
+                # cursor from the first token and returns the full text once
+                # the stream is done
+                final_content = st.write_stream(
+                    stream_content_chunks(call_deepseek_api(**api_kwargs, stream=True), reasoning_placeholder, collected)
                 )
+                final_reasoning = collected["reasoning"]
+                usage = collected.get("usage", {})
+                first_token = collected.get("first_token")
                 
-                # Handle streaming vs non-streaming
-                if st.session_state.stream:
-                    reasoning_placeholder = st.empty()
-                    content_placeholder = st.empty()
-                    
-                    reasoning_text = ""
-                    content_text = ""
-                    final_reasoning = ""
-                    final_content = ""
-                    
-                    for chunk in response_data:
-                        if chunk["type"] == "reasoning":
-                            reasoning_text += chunk["content"]
-                            with reasoning_placeholder.expander("🧠 Deep Thinking", expanded=False):
-                                st.markdown(reasoning_text + "▌")
-                        elif chunk["type"] == "content":
-                            content_text += chunk["content"]
-                            content_placeholder.markdown(content_text + "▌")
-                        elif chunk["type"] == "done":
-                            final_reasoning = chunk["reasoning"]
-                            final_content = chunk["content"]
-                            if reasoning_text:
-                                with reasoning_placeholder.expander("🧠 Deep Thinking", expanded=False):
-                                    st.markdown(final_reasoning)
-                            content_placeholder.markdown(final_content)
-                    
-                else:
-                    # Non-streaming
-                    result = response_data
-                    final_content = result["content"]
-                    final_reasoning = result["reasoning"]
-                    
-                    if final_reasoning:
-                        with st.expander("🧠 Deep Thinking", expanded=False):
-                            st.markdown(final_reasoning)
-                    st.markdown(final_content)
+            else:
+                # Non-streaming - the spinner only covers the blocking call
+                with st.spinner("Thinking..." if st.session_state.current_mode == "deepseek-reasoner" else "Processing..."):
+                    result = call_deepseek_api(**api_kwargs, stream=False)
+                final_content = result["content"]
+                final_reasoning = result["reasoning"]
+                usage = result.get("usage", {})
+                first_token = None  # Nothing is shown before the full reply
                 
-                # Add assistant response to history
-                st.session_state.messages.append({"role": "assistant", "content": final_content})
                 if final_reasoning:
-                    st.session_state.messages.append({"role": "assistant_reasoning", "content": final_reasoning})
+                    with st.expander("🧠 Deep Thinking", expanded=False):
+                        st.markdown(final_reasoning)
+                st.markdown(final_content)
+            
+            # Add assistant response to history
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": final_content,
+                "reasoning": final_reasoning or ""
+            })
+            st.session_state.api_messages.append({"role": "assistant", "content": final_content})
+            
+            # Per-turn timings - prompt_cache_hit_tokens is DeepSeek's count
+            # of prompt tokens served from its context cache
+            request_end = time.perf_counter()
+            st.session_state.latencies.append({
+                "model": st.session_state.current_mode,
+                "stream": st.session_state.stream,
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "cached_tokens": usage.get("prompt_cache_hit_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "ttft_s": round((first_token or request_end) - request_start, 3),
+                "total_s": round(request_end - request_start, 3)
+            })
+            trim_history()
+    
+    # Latency log for the session
+    if st.session_state.latencies:
+        with st.expander("⏱ Latency", expanded=False):
+            st.dataframe(st.session_state.latencies, use_container_width=True)
 
 # ============================================
 # MAIN APP EXECUTION